@@ -24,7 +24,7 @@ Setup script used for building, testing, and installing modules
 based on setuptools.
 """
 
-import codecs
+import io
 import os
 import re
 import sys
@@ -34,20 +34,28 @@ import setuptools
 from setuptools.command.install import install
 from setuptools.command.sdist import sdist
 
-# pylint: disable=import-error, wrong-import-position
-sys.path.insert(0, 'src')  # noqa: E402
-import virtBootstrap
-
 
 def read(fname):
     """
     Utility function to read the text file.
     """
     path = os.path.join(os.path.dirname(__file__), fname)
-    with codecs.open(path, encoding='utf-8') as fobj:
+    with io.open(path, encoding='utf-8') as fobj:
         return fobj.read()
 
 
+def get_version():
+    """
+    Read the version of virt-bootstrap without importing the package,
+    which would require all its dependencies to be installed.
+    """
+    content = read('src/virtBootstrap/virt_bootstrap.py')
+    return re.search(r'^__version__ = "([^"]+)"', content, re.M).group(1)
+
+
+VERSION = get_version()
+
+
 class PostInstallCommand(install):
     """
     Post-installation commands.
@@ -56,16 +64,23 @@ class PostInstallCommand(install):
         """
         Post install script
         """
-        cmd = [
-            'pod2man',
-            '--center=Container bootstrapping tool',
-            '--name=VIRT-BOOTSTRAP',
-            '--release=%s' % virtBootstrap.__version__,
-            'man/virt-bootstrap.pod',
-            'man/virt-bootstrap.1'
-        ]
-        if subprocess.call(cmd) != 0:
-            raise RuntimeError("Building man pages has failed")
+        src, dst = 'man/virt-bootstrap.pod', 'man/virt-bootstrap.1'
+        # Build the man page only if it is older than its source or the
+        # file which defines the version used as release.
+        if (not os.path.exists(dst)
+                or os.path.getmtime(dst) < max(
+                    os.path.getmtime(src),
+                    os.path.getmtime('src/virtBootstrap/virt_bootstrap.py'))):
+            cmd = [
+                'pod2man',
+                '--center=Container bootstrapping tool',
+                '--name=VIRT-BOOTSTRAP',
+                '--release=%s' % VERSION,
+                src,
+                dst
+            ]
+            if subprocess.call(cmd) != 0:
+                raise RuntimeError("Building man pages has failed")
         install.run(self)
 
 
@@ -94,12 +109,27 @@ class CheckPylint(setuptools.Command):
         """
         Call pycodestyle and pylint here.
         """
-        import pylint.lint
         import pycodestyle
 
         files = ["setup.py", "src/virtBootstrap/", "tests/"]
         output_format = "colorized" if sys.stdout.isatty() else "text"
 
+        pylint_opts = [
+            "--rcfile", "pylintrc",
+            "--output-format=%s" % output_format
+        ]
+
+        if self.errors_only:
+            pylint_opts.append("-E")
+
+        # The checks are independent, run pylint in separate process
+        # while pycodestyle checks the files.
+        pylint_proc = subprocess.Popen(
+            [sys.executable, "-m", "pylint"] + files + pylint_opts,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+
         print(">>> Running pycodestyle ...")
 
         style_guide = pycodestyle.StyleGuide(paths=files)
@@ -109,15 +139,14 @@ class CheckPylint(setuptools.Command):
 
         print(">>> Running pylint ...")
 
-        pylint_opts = [
-            "--rcfile", "pylintrc",
-            "--output-format=%s" % output_format
-        ]
+        sys.stdout.write(pylint_proc.communicate()[0])
+        sys.stdout.flush()
+        sys.exit(pylint_proc.returncode)
 
-        if self.errors_only:
-            pylint_opts.append("-E")
 
-        pylint.lint.Run(files + pylint_opts)
+# Patterns used to parse the output of git log in SdistCommand
+COMMIT_RE = re.compile(rb'([a-f0-9]+):(\d+)\s(.*)')
+SIGNED_OFF_RE = re.compile(rb'Signed-off-by')
 
 
 # SdistCommand is reused from the libvirt python binding (GPLv2+)
@@ -133,12 +162,14 @@ class SdistCommand(sdist):
         """
         Generate AUTHOS file out of git log
         """
-        fdlog = os.popen("git log --pretty=format:'%aN <%aE>'")
-        authors = []
-        for line in fdlog:
-            line = "   " + line.strip()
-            if line not in authors:
-                authors.append(line)
+        output = subprocess.run(
+            ['git', 'log', '--pretty=format:%aN <%aE>'],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True
+        ).stdout
+        # Remove duplicates while preserving the order of appearance
+        authors = list(dict.fromkeys(
+            "   " + line.strip() for line in output.splitlines()
+        ))
 
         authors.sort(key=str.lower)
 
@@ -150,25 +181,28 @@ class SdistCommand(sdist):
         """
         Generate ChangeLog file out of git log
         """
-        cmd = "git log '--pretty=format:%H:%ct %an  <%ae>%n%n%s%n%b%n'"
-        fd1 = os.popen(cmd)
-        fd2 = open("ChangeLog", 'w')
-
-        for line in fd1:
-            match = re.match(r'([a-f0-9]+):(\d+)\s(.*)', line)
+        # Process the output as bytes, it is written to file unchanged
+        output = subprocess.run(
+            ['git', 'log', '--pretty=format:%H:%ct %an  <%ae>%n%n%s%n%b%n'],
+            stdout=subprocess.PIPE, check=True
+        ).stdout
+
+        changelog = []
+        for line in output.splitlines():
+            match = COMMIT_RE.match(line)
             if match:
                 timestamp = time.gmtime(int(match.group(2)))
-                fd2.write("%04d-%02d-%02d %s\n" % (timestamp.tm_year,
-                                                   timestamp.tm_mon,
-                                                   timestamp.tm_mday,
-                                                   match.group(3)))
+                changelog.append(b"%04d-%02d-%02d %s\n" % (timestamp.tm_year,
+                                                           timestamp.tm_mon,
+                                                           timestamp.tm_mday,
+                                                           match.group(3)))
             else:
-                if re.match(r'Signed-off-by', line):
+                if SIGNED_OFF_RE.match(line):
                     continue
-                fd2.write("    " + line.strip() + "\n")
+                changelog.append(b"    " + line.strip() + b"\n")
 
-        fd1.close()
-        fd2.close()
+        with open("ChangeLog", 'wb') as changelog_file:
+            changelog_file.write(b''.join(changelog))
 
     def run(self):
         if not os.path.exists("build"):
@@ -193,7 +227,7 @@ class SdistCommand(sdist):
 
 setuptools.setup(
     name='virt-bootstrap',
-    version=virtBootstrap.__version__,
+    version=VERSION,
     author='Cedric Bosdonnat',
     author_email='cbosdonnat@suse.com',
     description='Container bootstrapping tool',
@@ -201,6 +235,7 @@ setuptools.setup(
     long_description=read('README.md'),
     url='https://github.com/virt-manager/virt-bootstrap',
     keywords='virtualization container rootfs',
+    python_requires='>=3.8',
     package_dir={"": "src"},
     packages=setuptools.find_packages('src'),
     test_suite='tests',
@@ -214,8 +249,8 @@ setuptools.setup(
         'Intended Audience :: System Administrators',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',  # noqa: 501
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
 
     ],
     cmdclass={
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Authors: Radostin Stoyanov <rstoyanov1@gmail.com>
+#
+# Copyright (c) 2019 Radostin Stoyanov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Module which contains functions to access the files cached in the
+directory of image layers.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+
+# pylint: disable=invalid-name
+logger = logging.getLogger(__name__)
+
+# File in the image directory which stores the signatures (size and
+# modification time) of layers with verified hash sum
+VERIFIED_LAYERS_FILE = '.verified.json'
+# Name of file which stores the details of image pinned by digest
+IMAGE_DETAILS_FILE = '.details-%s.json'
+
+
+def get_file_signature(path):
+    """
+    Return the size and modification time of file.
+    """
+    stat_info = os.stat(path)
+    return [stat_info.st_size, stat_info.st_mtime]
+
+
+def read_verified_layers(images_dir):
+    """
+    Read the signatures of layers with verified hash sum stored in
+    images_dir. Return dictionary which maps hash sum to signature.
+    """
+    return read_json_file(os.path.join(images_dir, VERIFIED_LAYERS_FILE),
+                          default={})
+
+
+def write_verified_layers(images_dir, verified_layers):
+    """
+    Atomically store the signatures of layers with verified hash sum
+    in images_dir.
+    """
+    write_json_file(os.path.join(images_dir, VERIFIED_LAYERS_FILE),
+                    verified_layers)
+
+
+def read_image_details(images_dir, digest):
+    """
+    Read the cached details of image with the given manifest digest.
+    Return None if the details are not stored in images_dir.
+    """
+    return read_json_file(os.path.join(images_dir,
+                                       IMAGE_DETAILS_FILE % digest))
+
+
+def write_image_details(images_dir, digest, image_details):
+    """
+    Store the details of image with the given manifest digest in
+    images_dir.
+    """
+    write_json_file(os.path.join(images_dir, IMAGE_DETAILS_FILE % digest),
+                    image_details)
+
+
+def read_json_file(path, default=None):
+    """
+    Return the content of JSON file or default if it could not be read.
+    """
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json_file(path, data):
+    """
+    Atomically write data to JSON file. Failures are only logged as the
+    file is used as cache.
+    """
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(tmp_fd, 'w') as handle:
+            json.dump(data, handle)
+        os.rename(tmp_path, path)
+    except OSError as err:
+        logger.debug("Failed to write %s: %s", path, err)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -22,6 +22,11 @@
 Store the progress of virt-bootstrap
 """
 
+import time
+
+# Minimal interval in seconds between callbacks which only update the value
+CALLBACK_INTERVAL = 0.1
+
 
 class Progress(object):
     """
@@ -29,6 +34,8 @@ class Progress(object):
     inform callback method about change.
     """
 
+    __slots__ = ('progress', 'callback', 'last_callback')
+
     def __init__(self, callback=None):
         """
         If callback method is passed it will be called when the progress
@@ -36,6 +43,7 @@ class Progress(object):
         """
         self.progress = {'status': '', 'value': 0}
         self.callback = callback
+        self.last_callback = 0.0
 
     def get_progress(self):
         """
@@ -54,15 +62,19 @@ class Progress(object):
                        including the status will be logged.
         """
         # Note: We do not validate the values stored in progress
-        if isinstance(status, str):
+        if status is not None:
             self.progress['status'] = status
-        if isinstance(value, (float, int)):
+        if value is not None:
             self.progress['value'] = value
 
-        try:
-            if logger is not None:
-                logger.info(status)
-            if self.callback is not None:
+        # Errors raised by logger or callback are propagated to the caller
+        if logger is not None:
+            logger.info(status)
+        if self.callback is not None:
+            # Status changes and completion are always reported, updates of
+            # the value alone are rate limited.
+            now = time.monotonic()
+            if (status is not None or value == 100
+                    or now - self.last_callback >= CALLBACK_INTERVAL):
+                self.last_callback = now
                 self.callback(self.get_progress())
-        except Exception as err:
-            raise ValueError("Progress update has failed.", err)
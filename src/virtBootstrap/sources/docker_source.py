@@ -22,13 +22,16 @@ extract the layers of root file system into destination directory or qcow2
 image with backing chains.
 """
 
-import select
 import shutil
 import getpass
 import os
 import logging
+import re
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+from virtBootstrap import cache
 from virtBootstrap import utils
 
 
@@ -36,6 +39,11 @@ from virtBootstrap import utils
 # Create logger
 logger = logging.getLogger(__name__)
 
+# Progress message of skopeo, e.g. "5.92 MiB / 44.96 MiB [===>-------]"
+PROGRESS_RE = re.compile(
+    r'^\s*([\d.]+)\s*([KMGT]?i?B)\s*/\s*([\d.]+)\s*([KMGT]?i?B)'
+)
+
 
 class DockerSource(object):
     """
@@ -80,6 +88,8 @@ class DockerSource(object):
         self.image_details = None
         self.layers = []
         self.checksums = []
+        self.whiteouts = None
+        self.verified_layers = {}
 
         if self.username and not self.password:
             self.password = getpass.getpass()
@@ -91,14 +101,33 @@ class DockerSource(object):
         Retrive manifest from registry and get layers' digest,
         sum_type, size and file_path in a list.
         """
-        image_details = utils.get_image_details(self.url, raw=False,
-                                                insecure=self.insecure,
-                                                username=self.username,
-                                                password=self.password)
+        # The manifest of image pinned by digest can not change, reuse
+        # the details stored by previous run to avoid the registry query.
+        digest = self.get_image_digest()
+        image_details = None
+        if digest and not self.no_cache:
+            image_details = cache.read_image_details(self.images_dir, digest)
+
+        if image_details is None:
+            image_details = utils.get_image_details(self.url, raw=False,
+                                                    insecure=self.insecure,
+                                                    username=self.username,
+                                                    password=self.password)
+            if digest and not self.no_cache:
+                cache.write_image_details(self.images_dir, digest,
+                                          image_details)
 
         if 'Layers' not in image_details or not image_details['Layers']:
             raise ValueError('No image layers.')
 
+        # Recent versions of skopeo report the size of layers, the size is
+        # -1 when it is not known (e.g. manifest with schema version 1).
+        sizes = {}
+        for layer in image_details.get('LayersData') or []:
+            size = layer.get('Size')
+            if isinstance(size, int) and size >= 0:
+                sizes[layer['Digest']] = size
+
         # Layers are in order:
         # - root layer first, and then successive layered layers
         # Ref: https://github.com/containers/image/blob/master/image/oci.go
@@ -108,8 +137,19 @@ class DockerSource(object):
 
             # Layers are tar files with hashsum used as name
             file_path = os.path.join(self.images_dir, layer_sum)
-            # Store 'file path' and set placeholder for 'size'
-            self.layers.append([file_path, None])
+            # Store 'file path' and 'size' if known
+            self.layers.append([file_path, sizes.get(layer_digest)])
+
+    def get_image_digest(self):
+        """
+        Return the hash sum of manifest digest when the image is referenced
+        by digest (e.g. "docker://fedora@sha256:<hash>"), otherwise None.
+        """
+        reference = self.url.rpartition('/')[2]
+        digest = reference.partition('@')[2]
+        if ':' not in digest:
+            return None
+        return digest.split(':', 1)[1]
 
     def gen_valid_uri(self, uri):
         """
@@ -126,7 +166,7 @@ class DockerSource(object):
         if image.endswith('/'):
             image = image[:-1]
 
-        return "docker://" + registry + image
+        return f"docker://{registry}{image}"
 
     def download_image(self):
         """
@@ -141,22 +181,32 @@ class DockerSource(object):
         # Note: we don't want to expose --src-cert-dir to users as
         #       they should place the certificates in the system
         #       folders for broader enablement
+        # Note: skopeo already fetches the layers of an image concurrently,
+        #       and the "dir:" transport does not allow to copy selected
+        #       blobs, hence the image is copied with single command.
         skopeo_copy = ["skopeo", "copy", self.url, "dir:" + dest_dir]
 
         if self.insecure:
             skopeo_copy.append('--src-tls-verify=false')
         if self.username:
-            skopeo_copy.append('--src-creds={}:{}'.format(self.username,
-                                                          self.password))
+            skopeo_copy.append(
+                f'--src-creds={self.username}:{self.password}'
+            )
         self.progress("Downloading container image", value=0, logger=logger)
-        # Run "skopeo copy" command
-        self.read_skopeo_progress(skopeo_copy)
-
-        if not self.no_cache:
-            os.remove(os.path.join(dest_dir, "manifest.json"))
-            os.remove(os.path.join(dest_dir, "version"))
-            utils.copytree(dest_dir, self.images_dir)
-            shutil.rmtree(dest_dir)
+        try:
+            # Run "skopeo copy" command
+            self.read_skopeo_progress(skopeo_copy)
+
+            if not self.no_cache:
+                # Keep only the blobs, the metadata files written by skopeo
+                # are removed together with the temporary directory.
+                utils.move_files(dest_dir, self.images_dir,
+                                 exclude=('manifest.json', 'version'))
+        finally:
+            # The temporary directory contains only the downloaded blobs,
+            # remove it also when the download has failed.
+            if not self.no_cache:
+                shutil.rmtree(dest_dir, ignore_errors=True)
 
         # Old versions of skopeo use '.tar' extension to blobs.
         # Make sure we use the correct file name.
@@ -166,65 +216,50 @@ class DockerSource(object):
                 if os.path.exists(path + '.tar'):
                     self.layers[i][0] += '.tar'
                 else:
-                    raise ValueError('Blob %s does not exist.' % path)
+                    raise ValueError(f'Blob {path} does not exist.')
 
     def parse_output(self, proc):
         """
-        Read stdout from skopeo's process asynchconosly.
+        Read stdout from skopeo's process line by line.
         """
         current_layer, total_layers_num = 0, len(self.layers)
 
-        # Process the output until the process terminates
-        while proc.poll() is None:
-            # Wait for data to become available
-            stdout = select.select([proc.stdout], [], [])[0]
-            # Split output into line
-            output = utils.read_async(stdout[0]).strip().split('\n')
-            for line in output:
-                line_split = line.split()
-                if len(line_split) > 2:  # Avoid short lines
-                    if utils.is_new_layer_message(line):
-                        current_layer += 1
-                        self.progress("Downloading layer (%s/%s)"
-                                      % (current_layer, total_layers_num))
-                    # Use the single slash between layer's "downloaded" and
-                    # "total size" in the output to recognise progress message
-                    elif line_split[2] == '/':
-                        self.update_progress_from_output(line_split,
-                                                         current_layer,
-                                                         total_layers_num)
-
-                    # Stop parsing when manifest is copied.
-                    elif utils.is_layer_config_message(line):
-                        break
+        # Process the output until skopeo closes its stdout
+        for line in iter(proc.stdout.readline, ''):
+            if utils.is_new_layer_message(line):
+                current_layer += 1
+                self.progress(f"Downloading layer ({current_layer}/"
+                              f"{total_layers_num})")
+
+            # Stop parsing when manifest is copied.
+            elif utils.is_layer_config_message(line):
+                break
+
             else:
-                continue  # continue if the inner loop didn't break
-            break
+                match = PROGRESS_RE.match(line)
+                if match:
+                    self.update_progress_from_output(match.groups(),
+                                                     current_layer,
+                                                     total_layers_num)
 
-        if proc.poll() is None:
-            proc.wait()  # Wait until the process is finished
+        proc.wait()  # Wait until the process is finished
         return proc.returncode == 0
 
-    def update_progress_from_output(self, line_split, current_l, total_l):
+    def update_progress_from_output(self, sizes, current_l, total_l):
         """
-        Parse a line from skopeo's output to extract the downloaded and
-        total size of image layer.
-
-        Calculate percentage and update the progress of virt-bootstrap.
+        Use the downloaded and total size of image layer extracted from
+        skopeo's output to calculate percentage and update the progress
+        of virt-bootstrap.
 
+        @param sizes: The groups matched by PROGRESS_RE with format:
+                (<d_size>, <d_format>, <t_size>, <t_format>)
+            Example:
+                ('5.92', 'MB', '44.96', 'MB')
         @param current_l: Number of currently downloaded layer
         @param total_l: Total number of layers
-        @param line_split: A list with format:
-                [<d_size>, <d_format>, '/', <t_size>, <t_format>, <progress>]
-            Example:
-                ['5.92', 'MB', '/', '44.96', 'MB', '[===>-----------------]']
         """
-
-        if not (len(line_split) > 4 and isinstance(line_split, list)):
-            return
-
-        d_size, d_format = utils.str2float(line_split[0]), line_split[1]
-        t_size, t_format = utils.str2float(line_split[3]), line_split[4]
+        d_size, d_format = utils.str2float(sizes[0]), sizes[1]
+        t_size, t_format = utils.str2float(sizes[2]), sizes[3]
 
         if d_size and t_size:
             downloaded_size = utils.size_to_bytes(d_size, d_format)
@@ -245,17 +280,67 @@ class DockerSource(object):
         """
         Parse the output from skopeo copy to track download progress.
         """
-        proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
-
-        # Without `make_async`, `fd.read` in `read_async` blocks.
-        utils.make_async(proc.stdout)
-        if not self.parse_output(proc):
-            raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
+        # Only stdout is read while skopeo is running. Redirect stderr to
+        # file to avoid blocking skopeo when the stderr pipe becomes full.
+        with tempfile.TemporaryFile(mode='w+') as stderr:
+            proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                universal_newlines=True,
+                bufsize=1
+            )
+            success = self.parse_output(proc)
+            proc.stdout.close()
+
+            stderr.seek(0)
+            err = stderr.read()
+            if err:
+                logger.debug("Stderr:\n%s", err)
+
+        if not success:
+            if err and not logger.isEnabledFor(logging.DEBUG):
+                logger.error("Stderr:\n%s", err)
+            raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd),
+                                                stderr=err)
+
+    def validate_layer(self, index):
+        """
+        Check if layer exists in image_dir and has valid hash sum.
+
+        Return tuple with the path of the layer and list of its whiteout
+        files, or None if the layer is not valid.
+        """
+        path, size = self.layers[index]
+        sum_type, sum_expected = self.checksums[index]
+        # When extracting into directory, collect the whiteout files of
+        # the layer while computing its hash sum to avoid reading the
+        # layer once again before extraction.
+        collect_whiteouts = self.output_format == 'dir'
+
+        logger.debug("Checking layer: %s", path)
+        candidates = [path]
+        if not path.endswith('.tar'):
+            candidates.append(path + '.tar')
+        signature = self.verified_layers.get(sum_expected)
+        for candidate in candidates:
+            if not os.path.exists(candidate):
+                continue
+            candidate_signature = cache.get_file_signature(candidate)
+            # Layer with different size than the one in manifest can not
+            # have valid hash sum.
+            if size is not None and candidate_signature[0] != size:
+                logger.debug("Size of layer does not match: %s", candidate)
+                continue
+            # Layers are named by their hash sum. Skip hashing of layers
+            # which have been verified and not modified since then.
+            if signature and signature == candidate_signature:
+                return candidate, None
+            whiteout_files = [] if collect_whiteouts else None
+            if utils.checksum(candidate, sum_type, sum_expected,
+                              whiteout_files):
+                return candidate, whiteout_files
+        return None
 
     def validate_image_layers(self):
         """
@@ -263,28 +348,54 @@ class DockerSource(object):
         and have valid hash sum.
         """
         self.progress("Checking cached layers", value=0, logger=logger)
-        for index, checksum in enumerate(self.checksums):
-            path = self.layers[index][0]
-            sum_type, sum_expected = checksum
+        if not self.layers:
+            return True
 
-            logger.debug("Checking layer: %s", path)
-            if (os.path.exists(path)
-                    and utils.checksum(path, sum_type, sum_expected)):
-                continue
-            if (not path.endswith('.tar')
-                    and os.path.exists(path + '.tar')
-                    and utils.checksum(path + '.tar', sum_type, sum_expected)):
-                self.layers[index][0] += '.tar'
-            else:
+        # Avoid computing hash sums when some of the layers is missing
+        for path, _ignore in self.layers:
+            if not (os.path.exists(path) or os.path.exists(path + '.tar')):
+                logger.debug("Layer is not cached: %s", path)
                 return False
+
+        if not self.no_cache:
+            self.verified_layers = cache.read_verified_layers(self.images_dir)
+
+        whiteouts = []
+        # Hash sums are computed with the GIL released, validate the
+        # layers in parallel.
+        workers = min(len(self.layers), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.validate_layer, index)
+                       for index in range(len(self.layers))]
+            for index, future in enumerate(futures):
+                result = future.result()
+                if result is None:
+                    # Discard the layers which are not being validated yet
+                    for pending in futures[index + 1:]:
+                        pending.cancel()
+                    return False
+                self.layers[index][0], whiteout_files = result
+                whiteouts.append(whiteout_files)
+
+        if self.output_format == 'dir':
+            self.whiteouts = whiteouts
+
+        if not self.no_cache:
+            verified_layers = dict(self.verified_layers)
+            for (path, _ignore), checksum in zip(self.layers, self.checksums):
+                verified_layers[checksum[1]] = cache.get_file_signature(path)
+            if verified_layers != self.verified_layers:
+                cache.write_verified_layers(self.images_dir, verified_layers)
+                self.verified_layers = verified_layers
         return True
 
     def fetch_layers(self):
         """
         Retrieve layers of container image.
         """
-        # Check if layers have been downloaded
-        if not self.validate_image_layers():
+        # Check if layers have been downloaded. The temporary image
+        # directory used without cache is always empty.
+        if self.no_cache or not self.validate_image_layers():
             self.download_image()
 
     def unpack(self, dest):
@@ -303,7 +414,8 @@ class DockerSource(object):
             if self.output_format == 'dir':
                 self.progress("Extracting container layers", value=50,
                               logger=logger)
-                utils.untar_layers(self.layers, dest, self.progress)
+                utils.untar_layers(self.layers, dest, self.progress,
+                                   self.whiteouts)
             elif self.output_format == 'qcow2':
                 self.progress("Extracting container layers into qcow2 images",
                               value=50, logger=logger)
@@ -326,7 +438,7 @@ class DockerSource(object):
                     )
 
             else:
-                raise Exception("Unknown format:" + self.output_format)
+                raise Exception(f"Unknown format:{self.output_format}")
 
         except Exception:
             raise
@@ -338,5 +450,6 @@ class DockerSource(object):
 
         finally:
             # Clean up
-            if self.no_cache and self.images_dir != utils.DEFAULT_IMG_DIR:
+            if (self.no_cache
+                    and self.images_dir != utils.get_default_image_dir()):
                 shutil.rmtree(self.images_dir)
@@ -23,16 +23,19 @@
 Module which contains utility functions used by virt-bootstrap.
 """
 
-import errno
-import fcntl
+import functools
 import hashlib
+import hmac
 import json
 import os
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 import logging
 import shutil
+from shlex import quote
 
 import passlib.hosts
 from virtBootstrap import whiteout
@@ -51,25 +54,72 @@ DEFAULT_OUTPUT_FORMAT = 'dir'
 # Default virtual size of qcow2 image
 DEF_QCOW2_SIZE = '5G'
 DEF_BASE_IMAGE_SIZE = 5 * 1024 * 1024 * 1024
-
-if os.geteuid() == 0:
-    LIBVIRT_CONN = "lxc:///"
-    DEFAULT_IMG_DIR = "/var/cache/virt-bootstrap/docker_images"
-else:
-    LIBVIRT_CONN = "qemu:///session"
-    if 'XDG_CACHE_HOME' in os.environ:
-        DEFAULT_IMG_DIR = os.environ['XDG_CACHE_HOME']
-    else:
-        DEFAULT_IMG_DIR = os.environ['HOME'] + '/.cache'
-    DEFAULT_IMG_DIR += '/virt-bootstrap/docker_images'
+# Size of the chunks used to read files when computing hash sums
+CHUNK_SIZE = 1024 * 1024
+# Maximal number of bytes of the next layer read ahead during extraction
+PREFETCH_SIZE = 256 * 1024 * 1024
+# Maximal number of bytes from the end of stderr kept for error reporting
+STDERR_LIMIT = 64 * 1024
+# Magic numbers of the compression formats supported by guestfs tar-in
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bzip2'),
+    (b'\x1f\x9d', 'compress'),
+    (b'\x89LZO\x00\r\n\x1a\n', 'lzop')
+)
+COMPRESSION_HEADER_SIZE = max(len(magic) for magic, _ in COMPRESSION_MAGIC)
+# Number of files passed to single guestfs lstatnslist call, this keeps
+# the reply below the size limit of guestfs protocol messages.
+GUESTFS_STAT_BATCH = 1000
+# Optional multi-threaded decompressors used by tar to extract layers
+PARALLEL_DECOMPRESSORS = {
+    'gzip': 'pigz',
+    'xz': 'pixz',
+    'bzip2': 'pbzip2'
+}
+# Hash algorithms used for the digests of image layers
+HASH_FACTORIES = {
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+    'sha1': hashlib.sha1
+}
+# Number of bytes in units of size used in the output of skopeo
+UNIT_BYTES = {
+    'B': 1,
+    'KB': 1 << 10, 'KIB': 1 << 10,
+    'MB': 1 << 20, 'MIB': 1 << 20,
+    'GB': 1 << 30, 'GIB': 1 << 30,
+    'TB': 1 << 40, 'TIB': 1 << 40
+}
 
 # Set temporary directory
 tmp_dir = os.environ.get('VIRTBOOTSTRAP_TMPDIR', '/tmp')
-if not os.path.exists(tmp_dir):
-    os.makedirs(tmp_dir)
+os.makedirs(tmp_dir, exist_ok=True)
 tempfile.tempdir = tmp_dir
 
 
+def get_libvirt_conn():
+    """
+    Get the URI of libvirt connection used by virt-sandbox.
+    """
+    if os.geteuid() == 0:
+        return "lxc:///"
+    return "qemu:///session"
+
+
+def get_default_image_dir():
+    """
+    Get the directory where downloaded image layers are cached.
+    """
+    if os.geteuid() == 0:
+        return "/var/cache/virt-bootstrap/docker_images"
+    # Fall back to the password database when HOME is not set
+    cache_dir = (os.environ.get('XDG_CACHE_HOME')
+                 or os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_dir, 'virt-bootstrap/docker_images')
+
+
 class BuildImage(object):
     """
     Use guestfs-python to create qcow2 disk images.
@@ -140,6 +190,9 @@ class BuildImage(object):
         log_layer_extract(
             tar_file, tar_size, index + 1, self.nlayers, self.progress
         )
+        # Read the next layer from disk while this one is extracted
+        if index + 1 < self.nlayers:
+            prefetch_file(self.layers[index + 1][0])
         self.tar_in(dev, tar_file)
 
     def tar_in(self, dev, tar_file):
@@ -200,78 +253,196 @@ def get_compression_type(tar_file):
     """
     Get compression type of tar file.
     """
-    # Get mime type of archive
-    mime_tar_file = get_mime_type(tar_file)
-    logger.debug("Detected mime type of archive: %s", mime_tar_file)
-
-    compression_fmts = {
-        'x-gzip': 'gzip',
-        'gzip': 'gzip',
-        'x-xz': 'xz',
-        'x-bzip2': 'bzip2',
-        'x-compress': 'compress',
-        'x-lzop': 'lzop'
-    }
+    # Detect the compression from the magic number of the file
+    with open(tar_file, 'rb') as handle:
+        header = handle.read(COMPRESSION_HEADER_SIZE)
 
-    # Check if tarball is compressed
-    mime_type, mime_subtype = mime_tar_file.split('/')
-    if mime_type == 'application' and mime_subtype in compression_fmts:
-        return compression_fmts[mime_subtype]
+    for magic, compression in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            logger.debug("Detected compression of archive: %s", compression)
+            return compression
     return None
 
 
-def checksum(path, sum_type, sum_expected):
+def get_hash_factory(sum_type):
+    """
+    Return constructor of hash object for the algorithm name.
+
+    Raise ValueError if the algorithm is not supported.
+    """
+    factory = HASH_FACTORIES.get(sum_type)
+    if factory is None:
+        # hashlib.new() returns the OpenSSL implementation of the
+        # algorithm when available.
+        hashlib.new(sum_type)  # Validate the algorithm name
+        factory = functools.partial(hashlib.new, sum_type)
+    return factory
+
+
+def hash_file(handle, sum_type):
+    """
+    Compute hash sum of file opened in binary mode.
+
+    Return the hash object.
+    """
+    hash_obj = get_hash_factory(sum_type)()
+    # Read the file in fixed-size chunks to keep memory usage bounded
+    # when validating large layers.
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    for size in iter(lambda: handle.readinto(buf), 0):
+        hash_obj.update(view[:size])
+    return hash_obj
+
+
+class HashReader(object):
+    """
+    File object wrapper which updates hash sum with the data being read.
+    """
+
+    def __init__(self, handle, hash_obj):
+        """
+        @param handle: File object opened in binary mode
+        @param hash_obj: Hash object to be updated
+        """
+        self.handle = handle
+        self.hash_obj = hash_obj
+
+    def read(self, size=-1):
+        """
+        Read data from the file and update the hash sum.
+        """
+        data = self.handle.read(size)
+        self.hash_obj.update(data)
+        return data
+
+
+def checksum(path, sum_type, sum_expected, whiteout_files=None):
     """
     Validate file using checksum.
+
+    @param whiteout_files: If a list is passed the file is parsed as tar
+                           archive while computing the hash sum, and the
+                           whiteout files found in it are appended to the
+                           list. This avoids reading the archive once more
+                           when the layer is extracted.
     """
-    algorithm = getattr(hashlib, sum_type)
     try:
-        handle = open(path, 'rb')
-        content = handle.read()
-        handle.close()
-
-        actual = algorithm(content).hexdigest()
-        if not actual == sum_expected:
+        expected = bytes.fromhex(sum_expected)
+        with open(path, 'rb', buffering=0) as handle:
+            # The layer is read once from start to end, let the kernel
+            # read ahead more aggressively.
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(handle.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+            if whiteout_files is None:
+                hash_obj = hash_file(handle, sum_type)
+            else:
+                hash_obj = get_hash_factory(sum_type)()
+                reader = HashReader(handle, hash_obj)
+                whiteout_files.extend(
+                    whiteout.get_whiteout_files(path, fileobj=reader)
+                )
+                # Include the data following the end-of-archive marker
+                for _ignore in iter(lambda: reader.read(CHUNK_SIZE), b''):
+                    pass
+
+        # Compare the raw digests in constant time
+        if not hmac.compare_digest(hash_obj.digest(), expected):
             logger.warning("File '%s' has invalid hash sum.\nExpected: %s\n"
-                           "Actual: %s", path, sum_expected, actual)
+                           "Actual: %s", path, sum_expected,
+                           hash_obj.hexdigest())
             return False
         return True
-    except Exception as err:
+    except (OSError, ValueError, tarfile.TarError) as err:
         logger.warning("Error occured while validating "
                        "the hash sum of file: %s\n%s", path, err)
         return False
 
 
+def prefetch_file(path, size=PREFETCH_SIZE):
+    """
+    Ask the kernel to start reading the first size bytes of file into the
+    page cache in the background. Errors are ignored as this is only an
+    optimisation.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        file_fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(file_fd, 0, size, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(file_fd)
+    except OSError as err:
+        logger.debug("Failed to prefetch %s: %s", path, err)
+
+
+def read_stderr(pipe, err, debug):
+    """
+    Read stderr of command until the end and keep the last STDERR_LIMIT
+    bytes of it in err. Each line is logged in debug mode.
+    """
+    for line in pipe:
+        if debug:
+            logger.debug("Stderr: %s", line.decode('utf-8', 'replace')
+                         .rstrip('\n'))
+        err += line
+        if len(err) > STDERR_LIMIT:
+            del err[:-STDERR_LIMIT]
+    pipe.close()
+
+
 def execute(cmd):
     """
     Execute command and log debug message.
+
+    The output of command is logged line by line in debug mode, and
+    discarded otherwise. The end of stderr is attached to the raised
+    CalledProcessError when the command fails.
     """
-    cmd_str = ' '.join(cmd)
-    logger.debug("Call command:\n%s", cmd_str)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Call command:\n%s", ' '.join(cmd))
 
     proc = subprocess.Popen(
         cmd,
-        stdout=subprocess.PIPE,
+        stdout=subprocess.PIPE if debug else subprocess.DEVNULL,
         stderr=subprocess.PIPE
     )
-    output, err = proc.communicate()
 
-    if output:
-        logger.debug("Stdout:\n%s", output.decode('utf-8'))
-    if err:
-        logger.debug("Stderr:\n%s", err.decode('utf-8'))
+    err = bytearray()
+    # Drain stderr in helper thread to avoid blocking the command
+    # while its stdout is being logged.
+    reader = threading.Thread(target=read_stderr,
+                              args=(proc.stderr, err, debug))
+    reader.start()
+    if debug:
+        for line in proc.stdout:
+            logger.debug("Stdout: %s", line.decode('utf-8', 'replace')
+                         .rstrip('\n'))
+        proc.stdout.close()
+    reader.join()
+    proc.wait()
 
     if proc.returncode != 0:
-        raise subprocess.CalledProcessError(proc.returncode, cmd_str)
+        err = err.decode('utf-8', 'replace')
+        if err and not debug:
+            logger.error("Stderr:\n%s", err)
+        raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd),
+                                            stderr=err)
 
 
 def safe_untar(src, dest):
     """
     Extract tarball within LXC container for safety.
+
+    @param src: Path to tarball, or list of paths to tarballs which are
+                extracted in order within single sandbox.
     """
     virt_sandbox = ['virt-sandbox',
                     '--security=inherit',
-                    '-c', LIBVIRT_CONN,
+                    '-c', get_libvirt_conn(),
                     '--name=bootstrap_%s' % os.getpid(),
                     '-m', 'host-bind:/mnt=' + dest]  # Bind destination folder
 
@@ -280,16 +451,48 @@ def safe_untar(src, dest):
     # Note: Here we use --absolute-names flag to get around the error message
     # "Cannot open: Permission denied" when symlynks are extracted, with the
     # qemu:/// driver. This flag must not be used outside virt-sandbox.
-    params = ['--', '/bin/tar', 'xf', src,
-              '-C', '/mnt',
-              '--exclude', 'dev/*',
-              '--exclude', '*/%s*' % whiteout.PREFIX,
-              '--overwrite',
-              '--absolute-names']
+    tar_opts = ['-C', '/mnt',
+                '--exclude', 'dev/*',
+                '--exclude', '*/%s*' % whiteout.PREFIX,
+                '--overwrite',
+                '--absolute-names']
     # Preserve file attributes following the specification in
     # https://github.com/opencontainers/image-spec/blob/master/layer.md
     if os.geteuid() == 0:
-        params.extend(['--acls', '--xattrs', '--selinux'])
+        tar_opts.extend(['--acls', '--xattrs', '--selinux'])
+
+    tar_files = src if isinstance(src, list) else [src]
+    # Read the beginning of the next tarball from disk while the first one
+    # is extracted. The following ones are not prefetched as they would
+    # evict the pages of the tarballs being extracted from the page cache.
+    if len(tar_files) > 1:
+        prefetch_file(tar_files[1])
+
+    decompressors = {}
+    tar_cmds = []
+    for tar_file in tar_files:
+        tar_cmd = ['/bin/tar', 'xf', tar_file]
+        # Decompress layers with multi-threaded implementation of the
+        # compression program when it is installed.
+        compression = get_compression_type(tar_file)
+        if compression in PARALLEL_DECOMPRESSORS:
+            if compression not in decompressors:
+                decompressors[compression] = is_installed(
+                    PARALLEL_DECOMPRESSORS[compression]
+                )
+            if decompressors[compression]:
+                tar_cmd.append('--use-compress-program=' +
+                               decompressors[compression])
+        tar_cmds.append(tar_cmd + tar_opts)
+
+    if len(tar_cmds) == 1:
+        params = ['--'] + tar_cmds[0]
+    else:
+        # Avoid starting new sandbox for each tarball
+        script = ' && '.join(
+            ' '.join(quote(arg) for arg in tar_cmd) for tar_cmd in tar_cmds
+        )
+        params = ['--', '/bin/sh', '-c', script]
     execute(virt_sandbox + params)
 
 
@@ -319,9 +522,8 @@ def size_to_bytes(number, fmt):
     """
     Convert human readable formats to bytes.
     """
-    formats = {'B': 0, 'KB': 1, 'MB': 2, 'GB': 3, 'TB': 4}
-    return (int(number) * pow(1024, formats[fmt.upper()]) if fmt in formats
-            else False)
+    unit = UNIT_BYTES.get(fmt.upper())
+    return int(float(number) * unit) if unit else False
 
 
 def log_layer_extract(tar_file, tar_size, current, total, progress):
@@ -337,49 +539,78 @@ def log_layer_extract(tar_file, tar_size, current, total, progress):
     logger.debug('Untar layer: %s', tar_file)
 
 
-def untar_layers(layers_list, dest_dir, progress):
+def extract_layers(tar_files, dest_dir, first, total, progress):
+    """
+    Extract consecutive layers within single sandbox and update the
+    progress once they are extracted.
+
+    @param first: Position of the first layer in the image
+    @param total: Number of layers in the image
+    """
+    last = first + len(tar_files) - 1
+    if first == last:
+        msg = 'Extracting layer (%s/%s)' % (first, total)
+    else:
+        msg = 'Extracting layers (%s-%s/%s)' % (first, last, total)
+    progress(msg, logger=logger)
+    safe_untar(tar_files, dest_dir)
+    progress(value=(float(last) / total * 50) + 50)
+
+
+def untar_layers(layers_list, dest_dir, progress, whiteouts=None):
     """
     Untar each of layers from container image.
+
+    Consecutive layers are extracted within single sandbox, unless a layer
+    contains whiteout files which have to be applied once its parent layers
+    are extracted.
+
+    @param whiteouts: Optional list containing the whiteout files of
+                      each layer, as collected by checksum().
     """
     nlayers = len(layers_list)
+    pending = []
     for index, layer in enumerate(layers_list):
         tar_file, tar_size = layer
-        log_layer_extract(tar_file, tar_size, index + 1, nlayers, progress)
+        whiteout_files = whiteouts[index] if whiteouts else None
+        if whiteout_files is None:
+            whiteout_files = whiteout.get_whiteout_files(tar_file)
+
+        if whiteout_files and pending:
+            # Extract parent layers before applying whiteout changes
+            extract_layers(pending, dest_dir, index - len(pending) + 1,
+                           nlayers, progress)
+            pending = []
+
+        logger.debug('Untar layer (%s/%s): %s with size: %s',
+                     index + 1, nlayers, tar_file,
+                     bytes_to_size(tar_size or os.path.getsize(tar_file)))
 
         # Apply whiteout changes with respect to parent layers
-        whiteout.apply_whiteout_changes(tar_file, dest_dir)
+        whiteout.apply_whiteout_changes(tar_file, dest_dir, whiteout_files)
 
-        # Extract layer tarball into destination directory
-        safe_untar(tar_file, dest_dir)
+        pending.append(tar_file)
 
-        # Update progress value
-        progress(value=(float(index + 1) / nlayers * 50) + 50)
+    if pending:
+        # Extract layer tarballs into destination directory
+        extract_layers(pending, dest_dir, nlayers - len(pending) + 1,
+                       nlayers, progress)
 
 
-def get_mime_type(path):
-    """
-    Get the mime type of a file.
+def move_files(src, dst, exclude=()):
     """
-    proc = subprocess.Popen(
-        ["/usr/bin/file", "--mime-type", path],
-        stdout=subprocess.PIPE
-    )
-    proc.wait()
-    with proc.stdout as output:
-        return output.read().decode('utf-8').split()[1]
+    Move the files of directory into an existing directory.
 
+    Files are renamed when both directories are on the same file system,
+    otherwise shutil copies them with os.sendfile() and removes the source.
 
-def copytree(src, dst, symlinks=False, ignore=None):
-    """
-    Copy an entire directory of files into an existing directory.
+    @param exclude: Names of files which are not moved
     """
-    for item in os.listdir(src):
-        src_item = os.path.join(src, item)
-        dst_item = os.path.join(dst, item)
-        if os.path.isdir(src_item):
-            shutil.copytree(src_item, dst_item, symlinks, ignore)
-        else:
-            shutil.copy2(src_item, dst_item)
+    with os.scandir(src) as entries:
+        names = [entry.name for entry in entries if entry.name not in exclude]
+    # Move the files once the directory has been read
+    for name in names:
+        shutil.move(os.path.join(src, name), os.path.join(dst, name))
 
 
 def get_image_dir(no_cache=False):
@@ -391,10 +622,9 @@ def get_image_dir(no_cache=False):
     if no_cache:
         return tempfile.mkdtemp('virt-bootstrap')
 
-    if not os.path.exists(DEFAULT_IMG_DIR):
-        os.makedirs(DEFAULT_IMG_DIR)
-
-    return DEFAULT_IMG_DIR
+    image_dir = get_default_image_dir()
+    os.makedirs(image_dir, exist_ok=True)
+    return image_dir
 
 
 def get_image_details(src, raw=False,
@@ -418,7 +648,9 @@ def get_image_details(src, raw=False,
     if error:
         raise ValueError("Image could not be retrieved:",
                          error.decode('utf-8'))
-    return json.loads(output.decode('utf-8'))
+    # json.loads() detects the encoding of bytes input, which avoids
+    # creating decoded copy of the output.
+    return json.loads(output)
 
 
 def is_new_layer_message(line):
@@ -437,27 +669,6 @@ def is_layer_config_message(line):
     return line.startswith('Copying config')
 
 
-def make_async(fd):
-    """
-    Add the O_NONBLOCK flag to a file descriptor.
-    """
-    fcntl.fcntl(fd, fcntl.F_SETFL,
-                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
-
-
-def read_async(fd):
-    """
-    Read some data from a file descriptor, ignoring EAGAIN errors
-    """
-    try:
-        return fd.read()
-    except IOError as e:
-        if e.errno != errno.EAGAIN:
-            raise
-        else:
-            return ''
-
-
 def str2float(element):
     """
     Convert string to float or return None.
@@ -472,8 +683,10 @@ def set_password_in_shadow_content(shadow_content, password, user='root'):
     """
     Find a user the content of shadow file and set a hash of the password.
     """
+    # Match the whole user name, e.g. "root" must not match "rootless"
+    prefix = user + ':'
     for index, line in enumerate(shadow_content):
-        if line.startswith(user):
+        if line.startswith(prefix):
             line_split = line.split(':')
             line_split[1] = passlib.hosts.linux_context.hash(password)
             shadow_content[index] = ':'.join(line_split)
@@ -511,16 +724,9 @@ def write_progress(prog):
     """
     Write progress output to console
     """
-    # Get terminal width
-    try:
-        terminal_width = int(
-            subprocess.Popen(
-                ["stty", "size"],
-                stdout=subprocess.PIPE
-            ).stdout.read().decode('utf-8').split()[1]
-        )
-    except Exception:
-        terminal_width = 80
+    # Get terminal width, the ioctl is cheap enough to query it on each
+    # update and follow changes of the terminal size.
+    terminal_width = shutil.get_terminal_size(fallback=(80, 24)).columns
     # Prepare message
     msg = "\rStatus: %s, Progress: %.2f%%" % (prog['status'], prog['value'])
     # Fill with whitespace and return cursor at the begging
@@ -591,37 +797,75 @@ def map_id(path, map_uid, map_gid):
     map_gid and map_uid: Contain integers in a list with format:
         [<start>, <target>, <count>]
     """
-    if map_uid:
-        uid_opts = get_mapping_opts(map_uid)
-    if map_gid:
-        gid_opts = get_mapping_opts(map_gid)
+    uid_opts = get_mapping_opts(map_uid) if map_uid else None
+    gid_opts = get_mapping_opts(map_gid) if map_gid else None
+
+    root_fd = os.open(os.path.realpath(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        new_uid, new_gid = get_new_ids(os.fstat(root_fd), uid_opts, gid_opts)
+        if new_uid != -1 or new_gid != -1:
+            os.fchown(root_fd, new_uid, new_gid)
+        map_id_in_dir(root_fd, uid_opts, gid_opts)
+    finally:
+        os.close(root_fd)
 
-    for root, _ignore, files in os.walk(os.path.realpath(path)):
-        for name in [root] + files:
-            file_path = os.path.join(root, name)
 
-            stat_info = os.lstat(file_path)
-            old_uid = stat_info.st_uid
-            old_gid = stat_info.st_gid
+def get_new_ids(stat_info, uid_opts, gid_opts):
+    """
+    Return tuple with the new UID and GID of file, -1 is returned for
+    ownership which does not have to be changed.
+    """
+    new_uid = get_map_id(stat_info.st_uid, uid_opts) if uid_opts else -1
+    new_gid = get_map_id(stat_info.st_gid, gid_opts) if gid_opts else -1
+    return new_uid, new_gid
 
-            new_uid = get_map_id(old_uid, uid_opts) if map_uid else -1
-            new_gid = get_map_id(old_gid, gid_opts) if map_gid else -1
-            os.lchown(file_path, new_uid, new_gid)
+
+def map_id_in_dir(dir_fd, uid_opts, gid_opts):
+    """
+    Remapping ownership of the files in directory opened as dir_fd and in
+    its subdirectories.
+
+    Files are accessed relative to the file descriptor of their parent
+    directory to avoid resolving the whole path for each of them.
+    """
+    with os.scandir(dir_fd) as entries:
+        for entry in entries:
+            new_uid, new_gid = get_new_ids(entry.stat(follow_symlinks=False),
+                                           uid_opts, gid_opts)
+            if new_uid != -1 or new_gid != -1:
+                os.chown(entry.name, new_uid, new_gid, dir_fd=dir_fd,
+                         follow_symlinks=False)
+
+            if entry.is_dir(follow_symlinks=False):
+                flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+                child_fd = os.open(entry.name, flags, dir_fd=dir_fd)
+                try:
+                    map_id_in_dir(child_fd, uid_opts, gid_opts)
+                finally:
+                    os.close(child_fd)
 
 
 def guestfs_walk(rootfs_tree, g, path='/'):
     """
     File system walk for guestfs
     """
-    stat = g.lstat(path)
-    rootfs_tree[path] = {'uid': stat['uid'], 'gid': stat['gid']}
-    for member in g.ls(path):
-        m_path = os.path.join(path, member)
-        if g.is_dir(m_path):
-            guestfs_walk(rootfs_tree, g, m_path)
-        else:
-            stat = g.lstat(m_path)
-            rootfs_tree[m_path] = {'uid': stat['uid'], 'gid': stat['gid']}
+    stat = g.lstatns(path)
+    rootfs_tree[path] = {'uid': stat['st_uid'], 'gid': stat['st_gid']}
+
+    # List all files with single call and get their ownership in batches
+    # to avoid round-trips to the appliance for each file.
+    with tempfile.NamedTemporaryFile() as find_output:
+        g.find0(path, find_output.name)
+        members = [member.decode('utf-8')
+                   for member in find_output.read().split(b'\0') if member]
+
+    for start in range(0, len(members), GUESTFS_STAT_BATCH):
+        batch = members[start:start + GUESTFS_STAT_BATCH]
+        for member, stat in zip(batch, g.lstatnslist(path, batch)):
+            rootfs_tree[os.path.join(path, member)] = {
+                'uid': stat['st_uid'],
+                'gid': stat['st_gid']
+            }
 
 
 def apply_mapping_in_image(uid, gid, rootfs_tree, g):
@@ -708,8 +952,13 @@ def is_installed(program):
 
     Returns the complete filename or None if not found.
     """
-    for path in os.environ["PATH"].split(os.pathsep):
-        exec_file = os.path.join(path, program)
-        if os.path.isfile(exec_file) and os.access(exec_file, os.X_OK):
-            return exec_file
-    return None
+    return find_executable(program, os.environ["PATH"])
+
+
+@functools.lru_cache(maxsize=None)
+def find_executable(program, search_path):
+    """
+    Search for executable in the directories of search_path. The result
+    is cached for each value of search_path.
+    """
+    return shutil.which(program, path=search_path)
@@ -28,10 +28,7 @@ import logging
 import sys
 import os
 from textwrap import dedent
-try:
-    from urlparse import urlparse
-except ImportError:
-    from urllib.parse import urlparse
+from urllib.parse import urlparse
 
 from virtBootstrap import sources
 from virtBootstrap import progress
@@ -43,17 +40,7 @@ __version__ = "1.1.1"
 
 gettext.bindtextdomain("virt-bootstrap", "/usr/share/locale")
 gettext.textdomain("virt-bootstrap")
-try:
-    gettext.install("virt-bootstrap",
-                    localedir="/usr/share/locale")
-except IOError:
-    try:
-        import __builtin__
-        # pylint: disable=undefined-variable
-        __builtin__.__dict__['_'] = unicode
-    except ImportError:
-        import builtin
-        builtin.__dict__['_'] = str
+gettext.install("virt-bootstrap", localedir="/usr/share/locale")
 
 # pylint: disable=invalid-name
 # Create logger
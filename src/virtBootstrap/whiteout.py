@@ -38,12 +38,17 @@ OPAQUE = METAPREFIX + ".opq"
 logger = logging.getLogger(__name__)
 
 
-def apply_whiteout_changes(tar_file, dest_dir):
+def apply_whiteout_changes(tar_file, dest_dir, whiteout_files=None):
     """
     Process files with whiteout prefix and apply
     changes in destination folder.
+
+    @param whiteout_files: List of whiteout files in tar_file. If not
+                           specified the list is read from the archive.
     """
-    for path in get_whiteout_files(tar_file):
+    if whiteout_files is None:
+        whiteout_files = get_whiteout_files(tar_file)
+    for path in whiteout_files:
         basename = os.path.basename(path)
         dirname = os.path.dirname(path)
         dirname = os.path.join(dest_dir, dirname)
@@ -51,12 +56,16 @@ def apply_whiteout_changes(tar_file, dest_dir):
         process_whiteout(dirname, basename)
 
 
-def get_whiteout_files(filepath):
+def get_whiteout_files(filepath, fileobj=None):
     """
     Return a list of whiteout files from tar file
+
+    @param fileobj: If passed, the archive is read sequentially from this
+                    file object instead of being opened from filepath.
     """
     whiteout_files = []
-    with tarfile.open(filepath) as tar:
+    mode = 'r' if fileobj is None else 'r|*'
+    with tarfile.open(filepath, mode, fileobj=fileobj) as tar:
         for path in tar.getnames():
             if os.path.basename(path).startswith(PREFIX):
                 whiteout_files.append(path)
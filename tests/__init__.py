@@ -45,8 +45,9 @@ from virtBootstrap import virt_bootstrap
 from virtBootstrap import sources
 from virtBootstrap import progress
 from virtBootstrap import utils
+from virtBootstrap import cache
 
-__all__ = ['virt_bootstrap', 'sources', 'progress', 'utils']
+__all__ = ['virt_bootstrap', 'sources', 'progress', 'utils', 'cache']
 
 
 DEFAULT_FILE_MODE = 0o755
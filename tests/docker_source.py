@@ -31,7 +31,9 @@ Description:
 5. Check the result.
 """
 
+import contextlib
 import copy
+import io
 import os
 import subprocess
 import unittest
@@ -377,3 +379,223 @@ class TestDockerSource(unittest.TestCase):
             m_getsize.return_value = None
             src_instance = self._mock_retrieve_layers_info(manifest, kwargs)[0]
         self.assertEqual(src_instance.layers, expected_result)
+
+    def test_retrieve_layers_info_uses_cached_details_of_digest(self):
+        """
+        Ensures that retrieve_layers_info() does not query the registry
+        for image pinned by digest when its details are cached.
+        """
+        manifest = {'schemaVersion': 2, 'Layers': ['sha256:a7050fc1']}
+        with mock.patch.multiple('virtBootstrap.utils',
+                                 get_image_details=mock.DEFAULT,
+                                 is_installed=mock.DEFAULT,
+                                 get_image_dir=mock.DEFAULT) as m_utils:
+            with mock.patch.multiple('virtBootstrap.cache',
+                                     read_image_details=mock.DEFAULT,
+                                     write_image_details=mock.DEFAULT
+                                     ) as m_cache:
+                m_utils['get_image_dir'].return_value = '/images_path'
+                m_cache['read_image_details'].return_value = manifest
+                src_instance = sources.DockerSource(
+                    uri=virt_bootstrap.urlparse(
+                        'docker://fedora@sha256:c6ff40'
+                    ),
+                    progress=mock.Mock()
+                )
+
+        m_cache['read_image_details'].assert_called_once_with(
+            '/images_path', 'c6ff40'
+        )
+        m_utils['get_image_details'].assert_not_called()
+        m_cache['write_image_details'].assert_not_called()
+        self.assertEqual(src_instance.layers,
+                         [['/images_path/a7050fc1', None]])
+
+    ###################################
+    # Tests for: validate_image_layers()
+    ###################################
+    @contextlib.contextmanager
+    def _mock_validate_utils(self):
+        """
+        Mock out the functions used by validate_image_layers() to access
+        the layers stored on disk.
+        """
+        with mock.patch.multiple('virtBootstrap.cache',
+                                 get_file_signature=mock.DEFAULT,
+                                 read_verified_layers=mock.DEFAULT,
+                                 write_verified_layers=mock.DEFAULT
+                                 ) as m_cache:
+            with mock.patch('virtBootstrap.utils.checksum') as m_checksum:
+                m_cache['checksum'] = m_checksum
+                yield m_cache
+
+    def test_validate_image_layers_checks_all_layers(self):
+        """
+        Ensures that validate_image_layers() returns True only when all
+        layers have valid hash sum and keeps the order of the layers.
+        """
+        manifest = {
+            'schemaVersion': 2,
+            'Layers': ['sha256:a7050fc1', 'sha256:c6ff40b6']
+        }
+        src_instance = self._mock_retrieve_layers_info(
+            manifest, {'uri': '', 'fmt': 'qcow2', 'progress': mock.Mock()}
+        )[0]
+
+        with self._mock_validate_utils() as m_utils:
+            with mock.patch('os.path.exists') as m_exists:
+                m_exists.return_value = True
+                m_utils['checksum'].side_effect = (
+                    lambda path, *args: path.endswith('.tar')
+                )
+                self.assertTrue(src_instance.validate_image_layers())
+                self.assertEqual(src_instance.layers, [
+                    ['/images_path/a7050fc1.tar', None],
+                    ['/images_path/c6ff40b6.tar', None]
+                ])
+
+                m_utils['checksum'].side_effect = (
+                    lambda path, *args: 'c6ff40b6' not in path
+                )
+                self.assertFalse(src_instance.validate_image_layers())
+
+    def test_validate_image_layers_skips_verified_layers(self):
+        """
+        Ensures that validate_image_layers() does not compute the hash sum
+        of layers which were verified and have not been modified since.
+        """
+        manifest = {'schemaVersion': 2, 'Layers': ['sha256:a7050fc1']}
+        src_instance = self._mock_retrieve_layers_info(
+            manifest, {'uri': '', 'progress': mock.Mock()}
+        )[0]
+
+        with self._mock_validate_utils() as m_utils:
+            m_utils['get_file_signature'].return_value = [10, 1.5]
+            m_utils['read_verified_layers'].return_value = {
+                'a7050fc1': [10, 1.5]
+            }
+            with mock.patch('os.path.exists') as m_exists:
+                m_exists.return_value = True
+                self.assertTrue(src_instance.validate_image_layers())
+
+        m_utils['checksum'].assert_not_called()
+        m_utils['write_verified_layers'].assert_not_called()
+        self.assertEqual(src_instance.whiteouts, [None])
+
+    def test_validate_image_layers_checks_size_of_layers(self):
+        """
+        Ensures that validate_image_layers() does not compute the hash sum
+        of layers which size differs from the one reported by skopeo.
+        """
+        manifest = {
+            'schemaVersion': 2,
+            'Layers': ['sha256:a7050fc1'],
+            'LayersData': [{'Digest': 'sha256:a7050fc1', 'Size': 10}]
+        }
+        src_instance = self._mock_retrieve_layers_info(
+            manifest, {'uri': '', 'progress': mock.Mock()}
+        )[0]
+        self.assertEqual(src_instance.layers,
+                         [['/images_path/a7050fc1', 10]])
+
+        with self._mock_validate_utils() as m_utils:
+            m_utils['get_file_signature'].return_value = [5, 1.5]
+            m_utils['read_verified_layers'].return_value = {}
+            with mock.patch('os.path.exists') as m_exists:
+                m_exists.return_value = True
+                self.assertFalse(src_instance.validate_image_layers())
+
+        m_utils['checksum'].assert_not_called()
+
+        # Unknown size reported by skopeo must not be used for validation
+        manifest['LayersData'][0]['Size'] = -1
+        src_instance = self._mock_retrieve_layers_info(
+            manifest, {'uri': '', 'progress': mock.Mock()}
+        )[0]
+        self.assertEqual(src_instance.layers,
+                         [['/images_path/a7050fc1', None]])
+
+        with self._mock_validate_utils() as m_utils:
+            m_utils['get_file_signature'].return_value = [5, 1.5]
+            m_utils['read_verified_layers'].return_value = {}
+            m_utils['checksum'].return_value = True
+            with mock.patch('os.path.exists') as m_exists:
+                m_exists.return_value = True
+                self.assertTrue(src_instance.validate_image_layers())
+
+        m_utils['checksum'].assert_called_once()
+
+    def test_validate_image_layers_missing_layer(self):
+        """
+        Ensures that validate_image_layers() does not compute any hash sum
+        when some of the layers is not cached.
+        """
+        manifest = {
+            'schemaVersion': 2,
+            'Layers': ['sha256:a7050fc1', 'sha256:c6ff40b6']
+        }
+        src_instance = self._mock_retrieve_layers_info(
+            manifest, {'uri': '', 'progress': mock.Mock()}
+        )[0]
+
+        with self._mock_validate_utils() as m_utils:
+            with mock.patch('os.path.exists') as m_exists:
+                m_exists.side_effect = lambda path: 'c6ff40b6' not in path
+                self.assertFalse(src_instance.validate_image_layers())
+
+        m_utils['checksum'].assert_not_called()
+
+    ###################################
+    # Tests for: parse_output()
+    ###################################
+    def test_parse_output_reads_until_config_is_copied(self):
+        """
+        Ensures that parse_output() reports the progress of each layer and
+        stops parsing once skopeo starts copying the config.
+        """
+        manifest = {'schemaVersion': 2, 'Layers': ['sha256:a7050fc1']}
+        src_instance = self._mock_retrieve_layers_info(
+            manifest, {'uri': '', 'progress': mock.Mock()}
+        )[0]
+        m_proc = mock.Mock(returncode=0)
+        m_proc.stdout = io.StringIO(
+            'Copying blob sha256:a7050fc1\n'
+            ' 5.92 MiB / 11.84 MiB [=====>------]\n'
+            'Copying config sha256:c6ff40b6\n'
+            'Writing manifest to image destination\n'
+        )
+        with mock.patch.object(src_instance,
+                               'update_progress_from_output') as m_update:
+            self.assertTrue(src_instance.parse_output(m_proc))
+
+        m_update.assert_called_once_with(('5.92', 'MiB', '11.84', 'MiB'),
+                                         1, 1)
+        src_instance.progress.assert_called_once_with(
+            'Downloading layer (1/1)'
+        )
+        m_proc.wait.assert_called_once_with()
+
+    ###################################
+    # Tests for: read_skopeo_progress()
+    ###################################
+    def test_read_skopeo_progress_failure_includes_stderr(self):
+        """
+        Ensures that read_skopeo_progress() logs the stderr of failed
+        skopeo and attaches it to the raised CalledProcessError.
+        """
+        manifest = {'schemaVersion': 2, 'Layers': ['sha256:a7050fc1']}
+        src_instance = self._mock_retrieve_layers_info(
+            manifest, {'uri': '', 'progress': mock.Mock()}
+        )[0]
+        cmd = ['/bin/sh', '-c', 'echo failure >&2; exit 1']
+        with mock.patch.object(src_instance, 'parse_output') as m_parse:
+            m_parse.side_effect = lambda proc: proc.wait() == 0
+            with mock.patch('virtBootstrap.sources.docker_source.logger') \
+                    as m_logger:
+                m_logger.isEnabledFor.return_value = False
+                with self.assertRaises(subprocess.CalledProcessError) as err:
+                    src_instance.read_skopeo_progress(cmd)
+
+        self.assertEqual(err.exception.returncode, 1)
+        self.assertEqual(err.exception.stderr, 'failure\n')
+        m_logger.error.assert_called_once_with("Stderr:\n%s", 'failure\n')
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Authors: Radostin Stoyanov <rstoyanov1@gmail.com>
+#
+# Copyright (C) 2017 Radostin Stoyanov
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Unit tests for methods defined in virtBootstrap.progress
+"""
+import unittest
+from . import mock
+from . import progress
+
+
+# pylint: disable=invalid-name
+class TestProgress(unittest.TestCase):
+    """
+    Ensures that the Progress class of virtBootstrap works as expected.
+    """
+
+    def _update_progress_at(self, prog, now, **kwargs):
+        """
+        Call update_progress() with time.monotonic() returning now.
+        """
+        with mock.patch('time.monotonic') as m_monotonic:
+            m_monotonic.return_value = now
+            prog.update_progress(**kwargs)
+
+    ###################################
+    # Tests for: update_progress()
+    ###################################
+    def test_progress_drops_value_updates_within_interval(self):
+        """
+        Ensures that updates of the value alone within CALLBACK_INTERVAL
+        are not passed to the callback but are still stored.
+        """
+        m_callback = mock.Mock()
+        prog = progress.Progress(m_callback)
+        self._update_progress_at(prog, 10.0, value=10)
+        self._update_progress_at(
+            prog, 10.0 + progress.CALLBACK_INTERVAL / 2, value=20
+        )
+
+        m_callback.assert_called_once_with({'status': '', 'value': 10})
+        self.assertEqual(prog.get_progress(), {'status': '', 'value': 20})
+
+        self._update_progress_at(
+            prog, 10.0 + progress.CALLBACK_INTERVAL * 2, value=30
+        )
+        m_callback.assert_called_with({'status': '', 'value': 30})
+        self.assertEqual(m_callback.call_count, 2)
+
+    def test_progress_reports_status_and_completion(self):
+        """
+        Ensures that changes of the status and value of 100 are always
+        passed to the callback.
+        """
+        m_callback = mock.Mock()
+        prog = progress.Progress(m_callback)
+        self._update_progress_at(prog, 10.0, value=10)
+        self._update_progress_at(prog, 10.0, status='Extracting', value=50)
+        self._update_progress_at(prog, 10.0, value=100)
+
+        self.assertEqual(m_callback.call_args_list, [
+            mock.call({'status': '', 'value': 10}),
+            mock.call({'status': 'Extracting', 'value': 50}),
+            mock.call({'status': 'Extracting', 'value': 100})
+        ])
+
+    def test_progress_propagates_callback_errors(self):
+        """
+        Ensures that exceptions raised by the callback are propagated to
+        the caller of update_progress().
+        """
+        m_callback = mock.Mock(side_effect=RuntimeError('Interrupted'))
+        prog = progress.Progress(m_callback)
+        with self.assertRaises(RuntimeError):
+            self._update_progress_at(prog, 10.0, status='Downloading')
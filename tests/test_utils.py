@@ -20,8 +20,17 @@
 """
 Unit tests for functions defined in virtBootstrap.utils
 """
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
 import unittest
+from . import mock
 from . import utils
+from . import cache
 
 
 # pylint: disable=invalid-name
@@ -62,6 +71,16 @@ class TestUtils(unittest.TestCase):
                                  expected_output[i])
                 i += 1
 
+    def test_utils_size_to_bytes_binary_prefix(self):
+        """
+        Ensures that size_to_bytes() accepts binary prefixes and fractional
+        sizes used in the output of skopeo.
+        """
+        self.assertEqual(utils.size_to_bytes(1.5, 'KiB'), 1536)
+        self.assertEqual(utils.size_to_bytes(5.92, 'MiB'), 6207569)
+        self.assertEqual(utils.size_to_bytes(2, 'GiB'), 2147483648)
+        self.assertFalse(utils.size_to_bytes(1, 'PB'))
+
     ###################################
     # Tests for: is_new_layer_message()
     ###################################
@@ -108,36 +127,464 @@ class TestUtils(unittest.TestCase):
             self.assertFalse(utils.is_layer_config_message(msg))
 
     ###################################
-    # Tests for: make_async()
+    # Tests for: str2float()
     ###################################
-    def test_utils_make_async(self):
+    def test_utils_str2float(self):
         """
-        Ensures that make_async() sets O_NONBLOCK flag on PIPE.
+        Validates the output of str2float() for some test cases.
         """
+        test_values = {'1': 1.0, 'test': None, '0': 0.0, '1.25': 1.25}
+        for test in test_values:
+            self.assertEqual(utils.str2float(test), test_values[test])
 
-        proc = utils.subprocess.Popen(
-            ["echo"],
-            stdout=utils.subprocess.PIPE
-        )
-        pipe = proc.stdout
+    ###################################
+    # Tests for: get_default_image_dir()
+    ###################################
+    def test_utils_get_default_image_dir(self):
+        """
+        Ensures that get_default_image_dir() uses XDG_CACHE_HOME for
+        unprivileged users and does not require HOME to be set.
+        """
+        with mock.patch('os.geteuid') as m_geteuid:
+            m_geteuid.return_value = 1000
+            with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': '/cache'}):
+                self.assertEqual(utils.get_default_image_dir(),
+                                 '/cache/virt-bootstrap/docker_images')
+            with mock.patch.dict('os.environ', clear=True):
+                self.assertTrue(utils.get_default_image_dir().endswith(
+                    '.cache/virt-bootstrap/docker_images'
+                ))
+            m_geteuid.return_value = 0
+            self.assertEqual(utils.get_default_image_dir(),
+                             '/var/cache/virt-bootstrap/docker_images')
 
-        fd = pipe.fileno()
-        F_GETFL = utils.fcntl.F_GETFL
-        O_NONBLOCK = utils.os.O_NONBLOCK
+    ###################################
+    # Tests for: get_compression_type()
+    ###################################
+    def test_utils_get_compression_type(self):
+        """
+        Ensures that get_compression_type() detects the compression format
+        from the magic number of the file.
+        """
+        headers = [
+            (b'\x1f\x8b\x08\x00', 'gzip'),
+            (b'\xfd7zXZ\x00\x00\x04', 'xz'),
+            (b'BZh91AY&SY', 'bzip2'),
+            (b'\x1f\x9d\x90', 'compress'),
+            (b'\x89LZO\x00\r\n\x1a\n\x10', 'lzop'),
+            (b'etc/hostname\x00', None)
+        ]
+        for header, compression in headers:
+            with tempfile.NamedTemporaryFile() as test_file:
+                test_file.write(header)
+                test_file.flush()
+                self.assertEqual(utils.get_compression_type(test_file.name),
+                                 compression)
 
-        self.assertFalse(utils.fcntl.fcntl(fd, F_GETFL) & O_NONBLOCK)
-        utils.make_async(fd)
-        self.assertTrue(utils.fcntl.fcntl(fd, F_GETFL) & O_NONBLOCK)
-        proc.wait()
-        pipe.close()
+    ###################################
+    # Tests for: set_password_in_shadow_content()
+    ###################################
+    def test_utils_set_password_in_shadow_content(self):
+        """
+        Ensures that set_password_in_shadow_content() sets the password
+        hash only for the line of the given user.
+        """
+        shadow_content = [
+            'rootless:!:17000:0:99999:7:::',
+            'root:!:17000:0:99999:7:::',
+            ''
+        ]
+        with mock.patch('passlib.hosts.linux_context.hash') as m_hash:
+            m_hash.return_value = '$6$hash'
+            result = utils.set_password_in_shadow_content(shadow_content,
+                                                          'secret')
+        m_hash.assert_called_once_with('secret')
+        self.assertEqual(result, [
+            'rootless:!:17000:0:99999:7:::',
+            'root:$6$hash:17000:0:99999:7:::',
+            ''
+        ])
 
     ###################################
-    # Tests for: str2float()
+    # Tests for: guestfs_walk()
     ###################################
-    def test_utils_str2float(self):
+    def test_utils_guestfs_walk(self):
         """
-        Validates the output of str2float() for some test cases.
+        Ensures that guestfs_walk() collects the ownership of all files
+        listed by find0 using batched lstatnslist calls.
         """
-        test_values = {'1': 1.0, 'test': None, '0': 0.0, '1.25': 1.25}
-        for test in test_values:
-            self.assertEqual(utils.str2float(test), test_values[test])
+        def find0(_directory, files):
+            with open(files, 'wb') as handle:
+                handle.write(b'etc\0etc/shadow\0bin\0')
+
+        def lstatnslist(_path, names):
+            return [{'st_uid': len(name), 'st_gid': 0} for name in names]
+
+        m_guestfs = mock.Mock()
+        m_guestfs.lstatns.return_value = {'st_uid': 0, 'st_gid': 0}
+        m_guestfs.find0.side_effect = find0
+        m_guestfs.lstatnslist.side_effect = lstatnslist
+
+        rootfs_tree = {}
+        with mock.patch.object(utils, 'GUESTFS_STAT_BATCH', 2):
+            utils.guestfs_walk(rootfs_tree, m_guestfs)
+
+        self.assertEqual(rootfs_tree, {
+            '/': {'uid': 0, 'gid': 0},
+            '/etc': {'uid': 3, 'gid': 0},
+            '/etc/shadow': {'uid': 10, 'gid': 0},
+            '/bin': {'uid': 3, 'gid': 0}
+        })
+        self.assertEqual(m_guestfs.lstatnslist.call_count, 2)
+
+    ###################################
+    # Tests for: map_id()
+    ###################################
+    def test_utils_map_id(self):
+        """
+        Ensures that map_id() changes the ownership of all files, including
+        symlinks to directories, relative to their parent directory.
+        """
+        rootfs = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(rootfs, 'usr', 'lib'))
+            open(os.path.join(rootfs, 'usr', 'lib', 'libc.so'), 'w').close()
+            os.symlink('usr/lib', os.path.join(rootfs, 'lib'))
+
+            map_uid = [os.getuid(), 1000, 1]
+            with mock.patch('os.chown') as m_chown, \
+                    mock.patch('os.fchown') as m_fchown:
+                utils.map_id(rootfs, map_uid, None)
+
+            m_fchown.assert_called_once_with(mock.ANY, 1000, -1)
+            self.assertEqual(
+                sorted(call[0][0] for call in m_chown.call_args_list),
+                ['lib', 'lib', 'libc.so', 'usr']
+            )
+            for call in m_chown.call_args_list:
+                self.assertEqual(call[0][1:], (1000, -1))
+                self.assertFalse(call[1]['follow_symlinks'])
+        finally:
+            shutil.rmtree(rootfs)
+
+    ###################################
+    # Tests for: write_progress()
+    ###################################
+    def test_utils_write_progress(self):
+        """
+        Ensures that write_progress() pads the message to the width of
+        terminal.
+        """
+        with mock.patch('shutil.get_terminal_size') as m_size, \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as m_out:
+            m_size.return_value = os.terminal_size((50, 24))
+            utils.write_progress({'status': 'Extracting', 'value': 50})
+        self.assertEqual(m_out.getvalue(),
+                         '\rStatus: Extracting, Progress: 50.00%'.ljust(50) +
+                         '\r')
+
+
+class TestCacheUtils(unittest.TestCase):
+    """
+    Ensures that functions of the utils module of virtBootstrap which
+    verify and manage the cached image layers work as expected.
+    """
+    ###################################
+    # Tests for: checksum()
+    ###################################
+    def test_utils_checksum(self):
+        """
+        Ensures that checksum() validates files larger than the size of
+        the chunks used to read them.
+        """
+        content = os.urandom(utils.CHUNK_SIZE * 2 + 10)
+        sum_expected = hashlib.sha256(content).hexdigest()
+        with tempfile.NamedTemporaryFile() as test_file:
+            test_file.write(content)
+            test_file.flush()
+            self.assertTrue(
+                utils.checksum(test_file.name, 'sha256', sum_expected)
+            )
+            self.assertFalse(
+                utils.checksum(test_file.name, 'sha256', '0' * 64)
+            )
+
+    def test_utils_checksum_collect_whiteout_files(self):
+        """
+        Ensures that checksum() validates tar archive and collects the
+        whiteout files in it when a list is passed.
+        """
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as test_file:
+            with tarfile.open(test_file.name, 'w:gz') as tar:
+                for name in ['etc/hosts', 'etc/.wh.fstab',
+                             'home/.wh..wh..opq']:
+                    tar.addfile(tarfile.TarInfo(name), io.BytesIO())
+            with open(test_file.name, 'rb') as handle:
+                sum_expected = hashlib.sha256(handle.read()).hexdigest()
+
+            whiteout_files = []
+            self.assertTrue(utils.checksum(test_file.name, 'sha256',
+                                           sum_expected, whiteout_files))
+        self.assertEqual(whiteout_files,
+                         ['etc/.wh.fstab', 'home/.wh..wh..opq'])
+
+    def test_utils_checksum_errors(self):
+        """
+        Ensures that checksum() returns False when the file can not be
+        read, but does not mask KeyboardInterrupt or SystemExit.
+        """
+        self.assertFalse(utils.checksum('/nonexistent', 'sha256', '0'))
+        with tempfile.NamedTemporaryFile() as test_file:
+            for exception in (KeyboardInterrupt, SystemExit):
+                with mock.patch.object(utils, 'hash_file') as m_hash_file:
+                    m_hash_file.side_effect = exception
+                    self.assertRaises(exception, utils.checksum,
+                                      test_file.name, 'sha256', '0' * 64)
+
+    ###################################
+    # Tests for: hash_file()
+    ###################################
+    def test_utils_hash_file_reads_in_chunks(self):
+        """
+        Ensures that hash_file() computes correct hash sum of file larger
+        than CHUNK_SIZE.
+        """
+        content = os.urandom(utils.CHUNK_SIZE + 10)
+        with tempfile.TemporaryFile() as test_file:
+            test_file.write(content)
+            test_file.seek(0)
+            hash_obj = utils.hash_file(test_file, 'sha256')
+        self.assertEqual(hash_obj.hexdigest(),
+                         hashlib.sha256(content).hexdigest())
+
+    ###################################
+    # Tests for: read/write_verified_layers()
+    ###################################
+    def test_utils_verified_layers(self):
+        """
+        Ensures that signatures stored with write_verified_layers() are
+        returned by read_verified_layers().
+        """
+        images_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(cache.read_verified_layers(images_dir), {})
+            layer = os.path.join(images_dir, 'a7050fc1')
+            open(layer, 'w').close()
+            verified = {'a7050fc1': cache.get_file_signature(layer)}
+            cache.write_verified_layers(images_dir, verified)
+            self.assertEqual(cache.read_verified_layers(images_dir), verified)
+        finally:
+            shutil.rmtree(images_dir)
+
+    ###################################
+    # Tests for: get_hash_factory()
+    ###################################
+    def test_utils_get_hash_factory(self):
+        """
+        Ensures that get_hash_factory() returns constructor of hash objects
+        and rejects unsupported algorithms.
+        """
+        self.assertEqual(utils.get_hash_factory('sha256')().name, 'sha256')
+        self.assertEqual(utils.get_hash_factory('md5')().name, 'md5')
+        self.assertRaises(ValueError, utils.get_hash_factory, 'foo')
+
+    ###################################
+    # Tests for: move_files()
+    ###################################
+    def test_utils_move_files(self):
+        """
+        Ensures that move_files() moves the files into existing directory
+        and replaces the files which already exist there.
+        """
+        src_dir = tempfile.mkdtemp()
+        dst_dir = tempfile.mkdtemp()
+        try:
+            for name, content in [('a7050fc1', 'new'), ('c6ff40b6', 'blob')]:
+                with open(os.path.join(src_dir, name), 'w') as handle:
+                    handle.write(content)
+            with open(os.path.join(dst_dir, 'a7050fc1'), 'w') as handle:
+                handle.write('old')
+            open(os.path.join(src_dir, 'version'), 'w').close()
+
+            utils.move_files(src_dir, dst_dir, exclude=('version',))
+
+            self.assertEqual(os.listdir(src_dir), ['version'])
+            self.assertEqual(sorted(os.listdir(dst_dir)),
+                             ['a7050fc1', 'c6ff40b6'])
+            with open(os.path.join(dst_dir, 'a7050fc1')) as handle:
+                self.assertEqual(handle.read(), 'new')
+        finally:
+            shutil.rmtree(src_dir)
+            shutil.rmtree(dst_dir)
+
+
+class TestProcessUtils(unittest.TestCase):
+    """
+    Ensures that functions of the utils module of virtBootstrap which
+    run external commands work as expected.
+    """
+    ###################################
+    # Tests for: untar_layers()
+    ###################################
+    def test_utils_untar_layers_batches_layers(self):
+        """
+        Ensures that untar_layers() extracts consecutive layers within
+        single sandbox and applies whiteout changes of a layer after its
+        parent layers are extracted.
+        """
+        layers = [['/layer0', 1], ['/layer1', 1], ['/layer2', 1]]
+        whiteouts = [[], [], ['etc/.wh.fstab']]
+        m_progress = mock.Mock()
+        calls = []
+        with mock.patch.object(utils, 'safe_untar') as m_untar:
+            with mock.patch.object(utils.whiteout,
+                                   'apply_whiteout_changes') as m_whiteout:
+                m_untar.side_effect = (
+                    lambda src, dest: calls.append(('untar', list(src)))
+                )
+                m_whiteout.side_effect = (
+                    lambda src, dest, files: calls.append(('whiteout', src))
+                )
+                utils.untar_layers(layers, '/dest', m_progress, whiteouts)
+
+        self.assertEqual(calls, [
+            ('whiteout', '/layer0'),
+            ('whiteout', '/layer1'),
+            ('untar', ['/layer0', '/layer1']),
+            ('whiteout', '/layer2'),
+            ('untar', ['/layer2'])
+        ])
+        self.assertEqual(m_progress.call_args_list, [
+            mock.call('Extracting layers (1-2/3)', logger=utils.logger),
+            mock.call(value=(2.0 / 3 * 50) + 50),
+            mock.call('Extracting layer (3/3)', logger=utils.logger),
+            mock.call(value=100)
+        ])
+
+    ###################################
+    # Tests for: safe_untar()
+    ###################################
+    def test_utils_safe_untar_uses_pigz(self):
+        """
+        Ensures that safe_untar() decompresses gzip tarballs with pigz
+        when it is installed.
+        """
+        with tempfile.NamedTemporaryFile() as gzip_file:
+            gzip_file.write(b'\x1f\x8bdata')
+            gzip_file.flush()
+            with mock.patch.multiple(utils, execute=mock.DEFAULT,
+                                     is_installed=mock.DEFAULT) as m_utils:
+                m_utils['is_installed'].return_value = '/usr/bin/pigz'
+                utils.safe_untar(gzip_file.name, '/dest')
+                self.assertIn('--use-compress-program=/usr/bin/pigz',
+                              m_utils['execute'].call_args[0][0])
+
+                m_utils['is_installed'].return_value = None
+                utils.safe_untar(gzip_file.name, '/dest')
+                self.assertNotIn('--use-compress-program=/usr/bin/pigz',
+                                 m_utils['execute'].call_args[0][0])
+
+    def test_utils_safe_untar_uses_pixz(self):
+        """
+        Ensures that safe_untar() decompresses xz tarballs with pixz and
+        does not use it for uncompressed tarballs.
+        """
+        with tempfile.NamedTemporaryFile() as xz_file, \
+                tempfile.NamedTemporaryFile() as tar_file:
+            xz_file.write(b'\xfd7zXZ\x00data')
+            xz_file.flush()
+            with mock.patch.multiple(utils, execute=mock.DEFAULT,
+                                     is_installed=mock.DEFAULT) as m_utils:
+                m_utils['is_installed'].return_value = '/usr/bin/pixz'
+                utils.safe_untar([xz_file.name, tar_file.name], '/dest')
+                m_utils['is_installed'].assert_called_once_with('pixz')
+                script = m_utils['execute'].call_args[0][0][-1]
+                self.assertEqual(
+                    script.count('--use-compress-program=/usr/bin/pixz'), 1
+                )
+
+    ###################################
+    # Tests for: is_installed()
+    ###################################
+    def test_utils_is_installed(self):
+        """
+        Ensures that is_installed() returns the path of executable found in
+        PATH and searches again when PATH changes.
+        """
+        bin_dir = tempfile.mkdtemp()
+        try:
+            program = os.path.join(bin_dir, 'virt-bootstrap-test')
+            with open(program, 'w') as handle:
+                handle.write('#!/bin/sh\n')
+            os.chmod(program, 0o755)
+
+            with mock.patch.dict(os.environ, {'PATH': '/nonexistent'}):
+                self.assertIsNone(utils.is_installed('virt-bootstrap-test'))
+            with mock.patch.dict(os.environ, {'PATH': bin_dir}):
+                self.assertEqual(utils.is_installed('virt-bootstrap-test'),
+                                 program)
+        finally:
+            shutil.rmtree(bin_dir)
+
+    ###################################
+    # Tests for: prefetch_file()
+    ###################################
+    def test_utils_safe_untar_prefetches_next_tarball(self):
+        """
+        Ensures that safe_untar() prefetches only the tarball following
+        the first one.
+        """
+        with mock.patch.multiple(utils, execute=mock.DEFAULT,
+                                 prefetch_file=mock.DEFAULT,
+                                 get_compression_type=mock.DEFAULT) as m_utils:
+            m_utils['get_compression_type'].return_value = None
+            utils.safe_untar(['/layer1', '/layer2', '/layer3'], '/dest')
+        m_utils['prefetch_file'].assert_called_once_with('/layer2')
+
+    def test_utils_prefetch_file_limits_size(self):
+        """
+        Ensures that prefetch_file() asks the kernel to read ahead at most
+        PREFETCH_SIZE bytes of the file.
+        """
+        with tempfile.NamedTemporaryFile() as test_file:
+            with mock.patch('os.posix_fadvise', create=True) as m_fadvise:
+                utils.prefetch_file(test_file.name)
+        m_fadvise.assert_called_once_with(mock.ANY, 0, utils.PREFETCH_SIZE,
+                                          os.POSIX_FADV_WILLNEED)
+
+    ###################################
+    # Tests for: execute()
+    ###################################
+    def test_utils_execute_failure_includes_stderr(self):
+        """
+        Ensures that execute() attaches stderr of failed command to the
+        raised CalledProcessError when debug logging is disabled.
+        """
+        with mock.patch.object(utils.logger, 'isEnabledFor') as m_enabled:
+            m_enabled.return_value = False
+            with self.assertRaises(subprocess.CalledProcessError) as context:
+                utils.execute(['/bin/sh', '-c',
+                               'echo output; echo failure >&2; exit 3'])
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.stderr, 'failure\n')
+
+    def test_utils_execute_logs_output_in_debug_mode(self):
+        """
+        Ensures that execute() logs stdout and stderr line by line when
+        debug logging is enabled.
+        """
+        with mock.patch.object(utils, 'logger') as m_logger:
+            m_logger.isEnabledFor.return_value = True
+            utils.execute(['/bin/sh', '-c', 'echo output; echo warning >&2'])
+        m_logger.debug.assert_any_call("Stdout: %s", 'output')
+        m_logger.debug.assert_any_call("Stderr: %s", 'warning')
+
+    def test_utils_read_stderr_keeps_end(self):
+        """
+        Ensures that read_stderr() keeps only the last STDERR_LIMIT bytes.
+        """
+        pipe = io.BytesIO(b'first\n' + b'x' * 10 + b'\n' + b'last\n')
+        err = bytearray()
+        with mock.patch.object(utils, 'STDERR_LIMIT', 8):
+            utils.read_stderr(pipe, err, False)
+        self.assertEqual(err, b'xx\nlast\n')